@@ -5,7 +5,11 @@ import pandas as pd
 import plotly.express as px
 import requests
 import io
+import os
+import hashlib
 import numpy as np
+import orjson
+import pyarrow.csv as pv
 import traceback
 
 # -------------------------
@@ -23,119 +27,102 @@ st.markdown("Visualize environmental impacts across all U.S. counties!")
 # -------------------------
 # Utility formatting funcs
 # -------------------------
-def format_to_3_sig_figs(value):
-    """Format a number to 3 significant digits"""
-    if value == 'N/A' or pd.isna(value):
-        return 'N/A'
-    try:
-        value = float(value)
-        if value == 0:
-            return '0.00'
-        import math
-        if abs(value) >= 1:
-            digits_before_decimal = int(math.floor(math.log10(abs(value)))) + 1
-            decimal_places = max(0, 3 - digits_before_decimal)
-        else:
-            decimal_places = -int(math.floor(math.log10(abs(value)))) + 2
-        return f"{value:.{decimal_places}f}"
-    except (ValueError, TypeError, OverflowError):
-        return 'N/A'
-
-def format_carbon_footprint_scientific(value):
-    if value == 'N/A' or pd.isna(value):
-        return 'N/A'
-    try:
-        value = float(value)
-        if value == 0:
-            return '0.00e+00'
-        return f"{value:.2e}"
-    except (ValueError, TypeError, OverflowError):
-        return 'N/A'
-
-def format_water_footprint_scientific(value):
-    if value == 'N/A' or pd.isna(value):
-        return 'N/A'
-    try:
-        value = float(value)
-        if value == 0:
-            return '0.00e+00'
-        return f"{value:.2e}"
-    except (ValueError, TypeError, OverflowError):
-        return 'N/A'
-
-def format_water_scarcity_footprint_scientific(value):
-    if value == 'N/A' or pd.isna(value):
-        return 'N/A'
-    try:
-        value = float(value)
-        if value == 0:
-            return '0.00e+00'
-        return f"{value:.2e}"
-    except (ValueError, TypeError, OverflowError):
-        return 'N/A'
+def format_to_3_sig_figs(series):
+    """Format a numeric Series to 3 significant digits ('N/A' for missing values)"""
+    a = series.to_numpy(dtype=float)
+    out = np.full(a.shape, 'N/A', dtype=object)
+    m = np.isfinite(a)
+    v = a[m]
+    with np.errstate(divide='ignore'):
+        magnitude = np.floor(np.log10(np.abs(v)))
+    decimal_places = np.where(np.abs(v) >= 1, np.maximum(0, 2 - magnitude), 2 - magnitude)
+    decimal_places[v == 0] = 2
+    out[m] = [f"{x:.{int(d)}f}" for x, d in zip(v, decimal_places)]
+    return out
+
+def format_sci_2e(series):
+    """Format a numeric Series in scientific notation with 2 decimals ('N/A' for missing values)"""
+    a = series.to_numpy(dtype=float)
+    out = np.full(a.shape, 'N/A', dtype=object)
+    m = np.isfinite(a)
+    out[m] = [f"{v:.2e}" for v in a[m]]
+    return out
 
 # -------------------------
 # Percentile category function
 # -------------------------
-def calculate_percentile_category(values):
-    """Calculate percentile categories for color coding (green/yellow/red/gray)."""
-    numeric_values = []
-    for val in values:
-        if val != 'N/A' and not pd.isna(val):
-            try:
-                numeric_values.append(float(val))
-            except (ValueError, TypeError):
-                continue
-    if len(numeric_values) == 0:
-        return ['gray'] * len(values)
-    p33 = np.percentile(numeric_values, 33)
-    p67 = np.percentile(numeric_values, 67)
-    colors = []
-    for val in values:
-        if val == 'N/A' or pd.isna(val):
-            colors.append('gray')
-        else:
-            try:
-                num_val = float(val)
-                if num_val <= p33:
-                    colors.append('green')
-                elif num_val <= p67:
-                    colors.append('yellow')
-                else:
-                    colors.append('red')
-            except (ValueError, TypeError):
-                colors.append('gray')
-    return colors
+CATEGORY_LABELS = np.array(['green', 'yellow', 'red', 'gray'])
+
+def calculate_percentile_category(series):
+    """Calculate percentile category codes for color coding (0=green, 1=yellow, 2=red, 3=gray).
+
+    Returns (int8 codes, p33, p67, valid_count); the percentiles are None when no value is valid.
+    """
+    arr = series.to_numpy(dtype=np.float64)
+    mask = ~np.isnan(arr)
+    codes = np.full(arr.shape, 3, dtype=np.int8)
+    valid_count = int(mask.sum())
+    if valid_count == 0:
+        return codes, None, None, 0
+    p33, p67 = np.percentile(arr[mask], [33, 67])
+    codes[mask] = np.digitize(arr[mask], [p33, p67], right=True)
+    return codes, p33, p67, valid_count
 
 # -------------------------
 # Data loading functions
 # -------------------------
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "statefilter")
+
+# One keep-alive session for all downloads (both sources live on raw.githubusercontent.com)
+SESSION = requests.Session()
+SESSION.headers.update({'Accept-Encoding': 'gzip'})
+
+def fetch_cached(url):
+    """Return the raw bytes for `url`, downloading only if no on-disk copy exists."""
+    path = os.path.join(CACHE_DIR, hashlib.sha1(url.encode()).hexdigest())
+    if os.path.exists(path):
+        with open(path, 'rb') as fh:
+            return fh.read()
+    response = SESSION.get(url, timeout=30)
+    response.raise_for_status()
+    # The disk copy is best effort: a read-only or full HOME must not fail the download
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as fh:
+            fh.write(response.content)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return response.content
+
 @st.cache_data
 def load_data():
-    """Load and process county data from kjhealy/fips-codes (robust to encoding)."""
+    """Load and process county data from kjhealy/fips-codes (UTF-8, falling back to latin-1)."""
     try:
         counties_url = "https://raw.githubusercontent.com/kjhealy/fips-codes/master/county_fips_master.csv"
-        response = requests.get(counties_url)
-        response.raise_for_status()
-
-        encodings_to_try = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']
-        for encoding in encodings_to_try:
-            try:
-                content = response.content.decode(encoding)
-                counties = pd.read_csv(io.StringIO(content))
-                break
-            except UnicodeDecodeError:
-                continue
-        else:
-            raise ValueError("Could not decode the FIPS reference CSV with attempted encodings")
+        raw = fetch_cached(counties_url)
+
+        # Parse with Arrow's C++ reader; latin-1 (which accepts any byte) covers non-UTF-8 copies
+        try:
+            raw.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'latin-1'
+        tab = pv.read_csv(io.BytesIO(raw), read_options=pv.ReadOptions(encoding=encoding))
+        counties = tab.to_pandas(types_mapper=pd.ArrowDtype)
 
         # Ensure relevant columns exist and are clean
         if not {'state_name', 'county_name', 'fips'}.issubset(counties.columns):
             # attempt to rename typical columns if mismatch
             counties = counties.rename(columns={c: c.strip() for c in counties.columns})
 
+        # Keep FIPS as integers for joining; the zero-padded string is only used for Plotly
+        counties['fips'] = pd.to_numeric(counties['fips'], errors='coerce').astype('Int32')
         counties = counties.dropna(subset=['state_name', 'county_name', 'fips'])
-        counties['fips'] = counties['fips'].astype(str).str.zfill(5)
         # If there is a state abbreviation column, keep it; otherwise create placeholder
         if 'state_abbr' not in counties.columns:
             counties['state_abbr'] = counties['state_name'].apply(lambda s: (s[:2].upper() if isinstance(s, str) else '??'))
@@ -148,14 +135,14 @@ def load_data():
 def load_emission_data():
     """Load emission factors from inputdata.xlsx (expected columns but robust)."""
     try:
-        emission_df = pd.read_excel('inputdata.xlsx', header=None)
+        emission_df = pd.read_excel('inputdata.xlsx', header=None, engine='calamine')
         # If the file has headers already, handle that by checking dtypes
         if emission_df.shape[1] < 5:
             raise ValueError("inputdata.xlsx must contain at least 5 columns (fips, EWIF, EF, ACF, SWI)")
         emission_df = emission_df.iloc[:, :5]  # take first 5 columns if more exist
         emission_df.columns = ['fips_raw', 'EWIF', 'EF', 'ACF', 'SWI']
-        emission_df['fips'] = emission_df['fips_raw'].astype(str).str.zfill(5)
-        emission_df = emission_df.dropna(subset=['fips_raw', 'EF'])
+        emission_df['fips'] = pd.to_numeric(emission_df['fips_raw'], errors='coerce').astype('Int32')
+        emission_df = emission_df.dropna(subset=['fips', 'EF'])
         return emission_df[['fips', 'EWIF', 'EF', 'ACF', 'SWI']]
     except FileNotFoundError:
         st.error("Error: 'inputdata.xlsx' not found in the working directory. Please add the file.")
@@ -164,17 +151,70 @@ def load_emission_data():
         st.error(f"Error loading emission data: {e}")
         return None
 
-@st.cache_data
+def round_coordinates(coords, ndigits=5):
+    """Recursively round a GeoJSON coordinate array to `ndigits` decimals."""
+    if isinstance(coords, (int, float)):
+        return round(coords, ndigits)
+    return [round_coordinates(c, ndigits) for c in coords]
+
+@st.cache_resource
 def load_geojson():
-    """Load geographic boundary data for counties (Plotly geojson)."""
+    """Load geographic boundary data for counties (Plotly geojson) plus a FIPS -> feature index."""
     try:
         url = "https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        gj = orjson.loads(fetch_cached(url))
+        # 5 decimals (~1 m) is plenty for a county map and shrinks the figure payload
+        for f in gj['features']:
+            geometry = f.get('geometry')
+            if geometry and 'coordinates' in geometry:
+                geometry['coordinates'] = round_coordinates(geometry['coordinates'])
+        feat_by_id = {str(f['id']): f for f in gj['features']}
+        return gj, feat_by_id
     except Exception as e:
         st.error(f"Error loading map data: {e}")
-        return None
+        return None, None
+
+@st.cache_data
+def build_aligned_table(data, emission_data, all_fips):
+    """Join county reference and emission inputs onto the geojson FIPS order as NumPy arrays."""
+    # Keep the geojson id next to the integer join key so every array comes from the merged frame
+    # (a repeated FIPS in either reference table adds rows, as a plain merge always did)
+    df = pd.DataFrame({
+        'geo_id': all_fips,
+        'fips': pd.to_numeric(pd.Series(all_fips), errors='coerce').astype('Int32'),
+    })
+    df = df.merge(
+        data[['fips', 'county_name', 'state_name', 'state_abbr']],
+        on='fips', how='left'
+    ).merge(
+        emission_data[['fips', 'EF', 'EWIF', 'ACF', 'SWI']],
+        on='fips', how='left'
+    )
+
+    # Fill missing values
+    df['county_name'] = df['county_name'].fillna('Unknown County')
+    df['state_name'] = df['state_name'].fillna('Unknown State')
+    df['state_abbr'] = df['state_abbr'].fillna('??')
+    state_code, state_names = pd.factorize(df['state_name'], sort=True)
+
+    # Emission factors stay numeric (NaN for missing) so the plot math is vectorized
+    factors = {
+        col.lower(): pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64)
+        for col in ['EF', 'EWIF', 'ACF', 'SWI']
+    }
+    return dict(
+        fips=df['geo_id'].to_numpy(dtype=object),
+        county_name=df['county_name'].to_numpy(dtype=object),
+        state_abbr=df['state_abbr'].to_numpy(dtype=object),
+        state_code=state_code.astype(np.int16),
+        state_names=list(state_names),
+        **factors
+    )
+
+@st.cache_data
+def get_state_options(_data):
+    """Sorted state names for the filter (the county table is loaded once, so it is not hashed)."""
+    return ["All States"] + sorted(_data["state_name"].dropna().unique().tolist())
 
 # -------------------------
 # Converters
@@ -205,12 +245,175 @@ def convert_to_liters_per_year(water_value, units):
     else:
         return 0
 
+# -------------------------
+# Figure construction
+# -------------------------
+# cache_resource keeps the Figure object itself: no pickling, and st.plotly_chart takes it without
+# re-validating. Each full-US entry holds its own copy of the geojson, hence the small max_entries.
+@st.cache_resource(max_entries=8)
+def build_figure(impact_metric, selected_state, onsite_power_kwh_per_year, onsite_water_l_per_year,
+                 _table, _geojson, _feat_by_id):
+    """Build the county choropleth for one set of inputs.
+
+    Returns (figure, info dict); the cached figure is shared and must not be mutated. The datasets
+    are passed with a leading underscore so Streamlit keys the cache on the four user inputs only;
+    they come from the cached loaders.
+    """
+    # Apply state filter as a boolean mask over the aligned arrays (local only)
+    if selected_state != "All States":
+        state_names = _table['state_names']
+        selected_code = state_names.index(selected_state) if selected_state in state_names else -1
+        mask = _table['state_code'] == selected_code
+    else:
+        mask = np.ones(len(_table['fips']), dtype=bool)
+
+    plot_df = pd.DataFrame({
+        'fips': _table['fips'][mask],
+        'county_name': _table['county_name'][mask],
+        'state_name': pd.Categorical.from_codes(_table['state_code'][mask], _table['state_names']),
+        'state_abbr': pd.Categorical(_table['state_abbr'][mask]),
+        'EF': _table['ef'][mask],
+        'EWIF': _table['ewif'][mask],
+        'ACF': _table['acf'][mask],
+        'SWI': _table['swi'][mask],
+    })
+
+    # Build filtered geojson with only the features of the selected state (All States uses the full geojson)
+    filtered_geojson = _geojson
+    if selected_state != "All States":
+        fips_to_plot = set(plot_df['fips'].tolist())
+        if len(fips_to_plot) > 0:
+            filtered_features = [_feat_by_id[f] for f in fips_to_plot if f in _feat_by_id]
+            if len(filtered_features) == 0:
+                # fallback - nothing matched; keep full geojson but inform user
+                st.warning(f"No counties found for state '{selected_state}' in the loaded datasets. Showing full US map.")
+            else:
+                filtered_geojson = {"type": "FeatureCollection", "features": filtered_features}
+
+    # ---------- Calculations ----------
+    # Without any on-site power or water there is nothing to compare: every county is N/A (gray)
+    inputs_zero = onsite_power_kwh_per_year == 0 and onsite_water_l_per_year == 0
+    if inputs_zero:
+        plot_df['carbon_footprint'] = np.nan
+        plot_df['water_footprint'] = np.nan
+        plot_df['water_scarcity_footprint'] = np.nan
+    else:
+        # Carbon footprint (kgCO2e/year): EF*Psite, N/A without on-site power
+        if onsite_power_kwh_per_year != 0:
+            plot_df['carbon_footprint'] = plot_df['EF'] * onsite_power_kwh_per_year
+        else:
+            plot_df['carbon_footprint'] = np.nan
+
+        # Water footprint: Wsite + EWIF*Psite (Wsite alone where EWIF is missing)
+        water_only = onsite_water_l_per_year if onsite_water_l_per_year > 0 else np.nan
+        plot_df['water_footprint'] = np.where(
+            plot_df['EWIF'].notna(),
+            plot_df['EWIF'] * onsite_power_kwh_per_year + onsite_water_l_per_year,
+            water_only
+        )
+
+        # Water scarcity footprint: ACF*Wsite + SWI*Psite (missing factors contribute 0)
+        plot_df['water_scarcity_footprint'] = (plot_df['ACF'].fillna(0) * onsite_water_l_per_year
+                                               + plot_df['SWI'].fillna(0) * onsite_power_kwh_per_year)
+
+    # Choose metric & unit
+    if impact_metric == "Carbon Footprint":
+        metric_column = 'carbon_footprint'
+        metric_unit = 'kgCO2e/year'
+    elif impact_metric == "Scope 1 & 2 Water Footprint":
+        metric_column = 'water_footprint'
+        metric_unit = 'L/year'
+    else:
+        metric_column = 'water_scarcity_footprint'
+        metric_unit = 'L/year'
+
+    # Format tooltip columns
+    plot_df['EF_formatted'] = format_to_3_sig_figs(plot_df['EF'])
+    plot_df['carbon_footprint_formatted'] = format_sci_2e(plot_df['carbon_footprint'])
+    plot_df['water_footprint_formatted'] = format_sci_2e(plot_df['water_footprint'])
+    plot_df['water_scarcity_footprint_formatted'] = format_sci_2e(plot_df['water_scarcity_footprint'])
+
+    # Color categories & numeric map
+    if inputs_zero:
+        codes, p33, p67, valid_count = np.full(len(plot_df), 3, dtype=np.int8), None, None, 0
+    else:
+        codes, p33, p67, valid_count = calculate_percentile_category(plot_df[metric_column])
+    plot_df['color_numeric'] = codes
+    plot_df['color_category'] = CATEGORY_LABELS[codes]
+
+    # Only the columns the figure references are handed to Plotly (it serializes what it gets)
+    plot_small = plot_df[['fips', 'county_name', 'state_name', 'state_abbr', 'color_numeric',
+                          'color_category', 'EF_formatted', 'carbon_footprint_formatted',
+                          'water_footprint_formatted', 'water_scarcity_footprint_formatted']]
+
+    # ---------- Plot using filtered_geojson ----------
+    fig = px.choropleth(
+        plot_small,
+        geojson=filtered_geojson,
+        locations='fips',
+        color='color_numeric',
+        color_continuous_scale=[
+            [0, 'green'],
+            [0.33, 'yellow'],
+            [0.67, 'red'],
+            [1, 'gray']
+        ],
+        range_color=(0, 3),
+        scope="usa",
+        title=f"{impact_metric} by County" + (f" — {selected_state}" if selected_state != "All States" else ""),
+        hover_name='county_name',
+        hover_data={
+            'state_name': ':',
+            'state_abbr': ':',
+            'fips': ':',
+            'color_numeric': False
+        },
+        custom_data=['county_name', 'state_name', 'state_abbr', 'fips',
+                     'EF_formatted', 'carbon_footprint_formatted', 'water_footprint_formatted',
+                     'water_scarcity_footprint_formatted', 'color_category']
+    )
+
+    # Zoom logic: zoom to selection only when a single state is chosen
+    if selected_state == "All States":
+        fig.update_geos(scope="usa", visible=False)
+    else:
+        fig.update_geos(fitbounds="locations", visible=False)
+
+    # Styling
+    fig.update_traces(marker_line_color='white', marker_line_width=0.5, showscale=False)
+    fig.update_geos(projection_type="albers usa", showlakes=True, lakecolor="lightblue", bgcolor="white")
+    fig.update_layout(margin={"r":0,"t":40,"l":0,"b":0}, coloraxis_showscale=False, height=600)
+
+    # Hover template
+    fig.update_traces(
+        hovertemplate="<b>%{customdata[0]}</b><br>"
+                      "State: %{customdata[1]} (%{customdata[2]})<br>"
+                      "FIPS: %{customdata[3]}<br>"
+                      "Carbon Emission Factor: %{customdata[4]}<br>"
+                      "Carbon Footprint: %{customdata[5]} kgCO2e/year<br>"
+                      "Water Footprint: %{customdata[6]} L/year<br>"
+                      "Water Scarcity Footprint: %{customdata[7]} L/year<br>"
+                      "Impact Category: %{customdata[8]}<br>"
+                      "<extra></extra>"
+    )
+
+    info = {
+        'metric_unit': metric_unit,
+        'inputs_zero': inputs_zero,
+        'p33': p33,
+        'p67': p67,
+        'valid_count': valid_count,
+        'n_counties': len(plot_df),
+        'n_features': len(filtered_geojson.get('features', [])),
+    }
+    return fig, info
+
 # -------------------------
 # Load datasets (with spinner)
 # -------------------------
 with st.spinner("Loading data..."):
     data = load_data()               # county ref (fips -> county_name, state_name)
-    geojson = load_geojson()         # full US counties geojson
+    geojson, feat_by_id = load_geojson()  # full US counties geojson + FIPS -> feature lookup
     emission_data = load_emission_data()  # your inputdata.xlsx
 
 if data is None or geojson is None:
@@ -287,10 +490,7 @@ with col1:
     # --- STATE FILTER ---
     st.markdown("---")
     st.subheader("State")
-    if data is not None:
-        state_options = ["All States"] + sorted(data["state_name"].dropna().unique().tolist())
-    else:
-        state_options = ["All States"]
+    state_options = get_state_options(data) if data is not None else ["All States"]
     selected_state = st.selectbox(
         "Filter by State:",
         state_options,
@@ -311,191 +511,29 @@ with col2:
     """)
 
     try:
-        # Build a dataframe of counties from the GEOJSON (IDs align with geojson features)
-        all_fips = [str(feat.get('id')) for feat in geojson.get('features', [])]
-        plot_df = pd.DataFrame({'fips': all_fips})
-
-        # Merge with county reference and emission inputs (do not mutate global 'data')
-        plot_df = plot_df.merge(
-            data[['fips', 'county_name', 'state_name', 'state_abbr']],
-            on='fips', how='left'
-        ).merge(
-            emission_data[['fips', 'EF', 'EWIF', 'ACF', 'SWI']],
-            on='fips', how='left'
-        )
-
-        # Fill missing values
-        plot_df['county_name'] = plot_df['county_name'].fillna('Unknown County')
-        plot_df['state_name'] = plot_df['state_name'].fillna('Unknown State')
-        plot_df['state_abbr'] = plot_df['state_abbr'].fillna('??')
-        plot_df['EF'] = plot_df['EF'].fillna('N/A')
-        plot_df['EWIF'] = plot_df['EWIF'].fillna('N/A')
-        plot_df['ACF'] = plot_df['ACF'].fillna('N/A')
-        plot_df['SWI'] = plot_df['SWI'].fillna('N/A')
-
-        # Apply state filter to plot_df (local only)
-        if selected_state != "All States":
-            plot_df = plot_df[plot_df['state_name'] == selected_state]
-
-        # Build set of FIPS we'll show (to filter geojson)
-        fips_to_plot = set(plot_df['fips'].dropna().astype(str).tolist())
-
-        # Build filtered geojson with only the features matching fips_to_plot
-        if selected_state != "All States" and len(fips_to_plot) > 0:
-            filtered_features = [feat for feat in geojson.get('features', []) if str(feat.get('id')) in fips_to_plot]
-            if len(filtered_features) == 0:
-                # fallback - nothing matched; keep full geojson but inform user
-                st.warning(f"No counties found for state '{selected_state}' in the loaded datasets. Showing full US map.")
-                filtered_geojson = geojson
-            else:
-                filtered_geojson = {"type": "FeatureCollection", "features": filtered_features}
-        else:
-            filtered_geojson = geojson
-
-        # ---------- Calculations ----------
-        # Carbon footprint (kgCO2e/year)
-        def calculate_carbon_footprint(ef_value, power_kwh_year):
-            if ef_value == 'N/A' or pd.isna(ef_value) or power_kwh_year == 0:
-                return 'N/A'
-            try:
-                return float(ef_value) * power_kwh_year
-            except (ValueError, TypeError):
-                return 'N/A'
-
-        # Water footprint: Wsite + EWIF*Psite
-        def calculate_water_footprint(ewif_value, power_kwh_year, water_l_year):
-            if ewif_value == 'N/A' or pd.isna(ewif_value):
-                return water_l_year if water_l_year > 0 else 'N/A'
-            try:
-                ewif_contribution = float(ewif_value) * power_kwh_year
-                total_wf = water_l_year + ewif_contribution
-                return total_wf
-            except (ValueError, TypeError):
-                return water_l_year if water_l_year > 0 else 'N/A'
-
-        # Water scarcity footprint: ACF*Wsite + SWI*Psite
-        def calculate_water_scarcity_footprint(acf_value, swi_value, power_kwh_year, water_l_year):
-            acf_contribution = 0
-            swi_contribution = 0
-            if acf_value != 'N/A' and not pd.isna(acf_value):
-                try:
-                    acf_contribution = float(acf_value) * water_l_year
-                except (ValueError, TypeError):
-                    acf_contribution = 0
-            if swi_value != 'N/A' and not pd.isna(swi_value):
-                try:
-                    swi_contribution = float(swi_value) * power_kwh_year
-                except (ValueError, TypeError):
-                    swi_contribution = 0
-            total_wsf = acf_contribution + swi_contribution
-            if total_wsf == 0 and water_l_year == 0 and power_kwh_year == 0:
-                return 'N/A'
-            return total_wsf
-
-        # Add columns (use the converted onsite kWh/year and L/year)
-        plot_df['carbon_footprint'] = plot_df['EF'].apply(lambda ef: calculate_carbon_footprint(ef, onsite_power_kwh_per_year))
-        plot_df['water_footprint'] = plot_df['EWIF'].apply(lambda ewif: calculate_water_footprint(ewif, onsite_power_kwh_per_year, onsite_water_l_per_year))
-        plot_df['water_scarcity_footprint'] = plot_df.apply(lambda row: calculate_water_scarcity_footprint(row['ACF'], row['SWI'], onsite_power_kwh_per_year, onsite_water_l_per_year), axis=1)
-
-        # Format tooltip columns
-        plot_df['EF_formatted'] = plot_df['EF'].apply(format_to_3_sig_figs)
-        plot_df['carbon_footprint_formatted'] = plot_df['carbon_footprint'].apply(format_carbon_footprint_scientific)
-        plot_df['water_footprint_formatted'] = plot_df['water_footprint'].apply(format_water_footprint_scientific)
-        plot_df['water_scarcity_footprint_formatted'] = plot_df['water_scarcity_footprint'].apply(format_water_scarcity_footprint_scientific)
-
-        # Choose metric & unit
-        if impact_metric == "Carbon Footprint":
-            metric_column = 'carbon_footprint'
-            metric_formatted_column = 'carbon_footprint_formatted'
-            metric_unit = 'kgCO2e/year'
-        elif impact_metric == "Scope 1 & 2 Water Footprint":
-            metric_column = 'water_footprint'
-            metric_formatted_column = 'water_footprint_formatted'
-            metric_unit = 'L/year'
-        else:
-            metric_column = 'water_scarcity_footprint'
-            metric_formatted_column = 'water_scarcity_footprint_formatted'
-            metric_unit = 'L/year'
-
-        # Color categories & numeric map
-        plot_df['color_category'] = calculate_percentile_category(plot_df[metric_column])
-        color_map = {'green': 0, 'yellow': 1, 'red': 2, 'gray': 3}
-        plot_df['color_numeric'] = plot_df['color_category'].map(color_map)
+        # County table aligned to the geojson feature order (built once, cached)
+        table = build_aligned_table(data, emission_data, list(feat_by_id))
+        fig, info = build_figure(impact_metric, selected_state,
+                                 onsite_power_kwh_per_year, onsite_water_l_per_year,
+                                 table, geojson, feat_by_id)
+        metric_unit = info['metric_unit']
 
         # Debug info (optional but useful)
         st.write(f"Selected metric: {impact_metric}")
-        st.write(f"Counties plotted: {len(plot_df)}  |  GeoJSON features included: {len(filtered_geojson.get('features', []))}")
-
-        # ---------- Plot using filtered_geojson ----------
-        fig = px.choropleth(
-            plot_df,
-            geojson=filtered_geojson,
-            locations='fips',
-            color='color_numeric',
-            color_continuous_scale=[
-                [0, 'green'],
-                [0.33, 'yellow'],
-                [0.67, 'red'],
-                [1, 'gray']
-            ],
-            range_color=(0, 3),
-            scope="usa",
-            title=f"{impact_metric} by County" + (f" — {selected_state}" if selected_state != "All States" else ""),
-            hover_name='county_name',
-            hover_data={
-                'state_name': ':',
-                'state_abbr': ':',
-                'fips': ':',
-                'color_numeric': False
-            },
-            custom_data=['county_name', 'state_name', 'state_abbr', 'fips',
-                         'EF_formatted', 'carbon_footprint_formatted', 'water_footprint_formatted',
-                         'water_scarcity_footprint_formatted', 'color_category']
-        )
-
-        # Zoom logic: zoom to selection only when a single state is chosen
-        if selected_state == "All States":
-            fig.update_geos(scope="usa", visible=False)
-        else:
-            fig.update_geos(fitbounds="locations", visible=False)
-
-        # Styling
-        fig.update_traces(marker_line_color='white', marker_line_width=0.5, showscale=False)
-        fig.update_geos(projection_type="albers usa", showlakes=True, lakecolor="lightblue", bgcolor="white")
-        fig.update_layout(margin={"r":0,"t":40,"l":0,"b":0}, coloraxis_showscale=False, height=600)
-
-        # Hover template
-        fig.update_traces(
-            hovertemplate="<b>%{customdata[0]}</b><br>"
-                          "State: %{customdata[1]} (%{customdata[2]})<br>"
-                          "FIPS: %{customdata[3]}<br>"
-                          "Carbon Emission Factor: %{customdata[4]}<br>"
-                          "Carbon Footprint: %{customdata[5]} kgCO2e/year<br>"
-                          "Water Footprint: %{customdata[6]} L/year<br>"
-                          "Water Scarcity Footprint: %{customdata[7]} L/year<br>"
-                          "Impact Category: %{customdata[8]}<br>"
-                          "<extra></extra>"
-        )
+        st.write(f"Counties plotted: {info['n_counties']}  |  GeoJSON features included: {info['n_features']}")
 
         st.plotly_chart(fig, use_container_width=True)
 
         # ---------- Stats ----------
-        valid_values = []
-        for val in plot_df[metric_column]:
-            if val != 'N/A' and not pd.isna(val):
-                try:
-                    valid_values.append(float(val))
-                except (ValueError, TypeError):
-                    continue
-        if len(valid_values) > 0:
-            p33 = np.percentile(valid_values, 33)
-            p67 = np.percentile(valid_values, 67)
+        if info['valid_count'] > 0:
             st.markdown(f"""
             **{impact_metric} Statistics:**
-            - **33rd Percentile:** {p33:.2e} {metric_unit}
-            - **67th Percentile:** {p67:.2e} {metric_unit}
-            - **Counties with data:** {len(valid_values)} out of {len(plot_df)}
+            - **33rd Percentile:** {info['p33']:.2e} {metric_unit}
+            - **67th Percentile:** {info['p67']:.2e} {metric_unit}
+            - **Counties with data:** {info['valid_count']} out of {info['n_counties']}
             """)
+        elif info['inputs_zero']:
+            st.info("Enter on-site power generation and/or water consumption to calculate impacts.")
         else:
             st.warning(f"No valid data available for {impact_metric}")
 